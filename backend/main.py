@@ -1,24 +1,31 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import datetime
+import functools
 import os
 import logging
 from typing import Dict, Any, Optional, List
 import pandas as pd
-from pydantic import BaseModel, validator, Field
+from pydantic import BaseModel, field_validator, Field
 from pydantic_ai import Agent, RunContext
 import RestrictedPython
 from RestrictedPython import safe_builtins, compile_restricted
 from RestrictedPython.Guards import safe_globals, guarded_iter_unpack_sequence
 import json
 import re
-import pprint
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
 from pathlib import Path
 from dotenv import load_dotenv
+import aiofiles
 import black
+import orjson
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Get the project root directory
@@ -39,15 +46,37 @@ class ExcelQueryResult(BaseModel):
     result: Any
     explanation: str
 
+# Black 格式化純屬美化，預設關閉以避免在熱路徑上解析代碼
+FORMAT_CODE = os.getenv("FORMAT_LLM_CODE") == "1"
+_BLACK_MODE = black.Mode()
+
 def format_code_with_black(code: str) -> str:
+    if not FORMAT_CODE:
+        return code
     try:
         # 使用 Black 格式化代碼
-        formatted_code = black.format_str(code, mode=black.Mode())
+        formatted_code = black.format_str(code, mode=_BLACK_MODE)
         return formatted_code
     except black.InvalidInput:
         # 如果代碼無效，返回原始代碼
         return code
 
+# 提取 ```python 代碼塊用的正則，單次掃描取代 find/rfind
+_CODE_FENCE = re.compile(r"```(?:python)?\s*\n?(.*?)```", re.DOTALL)
+
+# 清理生成代碼用的正則：四個模式合併成一個交替式，單趟掃描完成
+_CLEAN_RE = re.compile(
+    r"RunResult\(.*?\)"         # 移除 RunResult
+    r"|ModelResponse\(.*?\)"    # 移除 ModelResponse
+    r"|TextPart\(.*?\)"         # 移除 TextPart
+    r"|2\..*?result.*?最終結果。.*?\n",  # 特定結果信息的模式
+    re.DOTALL,
+)
+
+# 轉義字符修正表：單次掃描取代三連 str.replace
+_ESC_MAP = {'\\\\': '\\', "\\'": "'", '\\"': '"'}
+_ESC_RE = re.compile('|'.join(re.escape(k) for k in _ESC_MAP))
+
 class CleanCodeResult(BaseModel):
     """清理代碼的結果"""
     code: str = Field(description="清理後的代碼")
@@ -56,15 +85,14 @@ class CleanCodeResult(BaseModel):
         if isinstance(data.get('code'), str):
             # 從代碼塊中提取代碼
             code = data['code']
-            if '```python' in code:
-                start = code.find('```python') + 9
-                end = code.rfind('```')
-                if end > start:
-                    code = code[start:end].strip()
+            m = _CODE_FENCE.search(code)
+            if m:
+                code = m.group(1).strip()
             data['code'] = code
         super().__init__(**data)
 
-    @validator('code')
+    @field_validator('code', mode='before')
+    @classmethod
     def clean_code(cls, value):
         """清理生成的代碼"""
         # 如果有 data 屬性，提取其內容
@@ -75,32 +103,22 @@ class CleanCodeResult(BaseModel):
         value = str(value)
 
         # 正則清理不必要的內容
-        patterns_to_remove = [
-            r"RunResult\(.*?\)",        # 移除 RunResult
-            r"ModelResponse\(.*?\)",   # 移除 ModelResponse
-            r"TextPart\(.*?\)",        # 移除 TextPart
-            r"2\..*?result.*?最終結果。.*?\n"  # 特定結果信息的模式
-        ]
-
-        for pattern in patterns_to_remove:
-            value = re.sub(pattern, "", value, flags=re.DOTALL)
+        value = _CLEAN_RE.sub("", value)
 
         # 修正轉義字符問題
-        value = value.replace('\\\\', '\\')
-        value = value.replace("\\'", "'")
-        value = value.replace('\\"', '"')
+        value = _ESC_RE.sub(lambda m: _ESC_MAP[m.group()], value)
 
         # 移除空白行和多餘的空格
         lines = [line.rstrip() for line in value.splitlines() if line.strip()]
         value = '\n'.join(lines)
 
         # 返回清理後的結果
-        try:
-            value = black.format_str(value, mode=black.Mode())
-            print(value)
-        except black.InvalidInput:
-            # 如果代碼無效，保持清理後的原樣
-            pass
+        if FORMAT_CODE:
+            try:
+                value = black.format_str(value, mode=_BLACK_MODE)
+            except black.InvalidInput:
+                # 如果代碼無效，保持清理後的原樣
+                pass
         return value.strip()
 
 class AgentDependencies(BaseModel):
@@ -109,13 +127,11 @@ class AgentDependencies(BaseModel):
     
     def __init__(self, **data):
         super().__init__(**data)
-        logger.info(f"Creating AgentDependencies with data: {data}")
         # 確保文件路徑是絕對路徑
         if not os.path.isabs(self.file_path):
             self.file_path = os.path.abspath(self.file_path)
         # 標準化路徑分隔符
         self.file_path = os.path.normpath(self.file_path)
-        logger.info(f"Initialized AgentDependencies with file_path: {self.file_path}")
 
 class AnalysisResult(BaseModel):
     content: str
@@ -132,10 +148,38 @@ class Tool(BaseModel):
     type: str = "function"
     function: Dict[str, Any]
 
+# 已載入 DataFrame 的快取，鍵為 (路徑, mtime)，文件更新時自動失效
+_DF_CACHE: "OrderedDict[tuple, pd.DataFrame]" = OrderedDict()
+_DF_CACHE_MAX = 8
+
+# 生成代碼的快取，鍵為 (路徑, 文件簽名, 查詢)；命中時省掉整個 LLM 往返
+_CODE_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_CODE_CACHE_MAX = 1024
+
+# 查詢分詞用的正則
+_WORD_RE = re.compile(r"\w+")
+
+# 單次掃描判斷查詢操作類型，取代多次 query.lower() + in 檢查
+_OP_RE = re.compile(
+    r"\b(sum|total|average|mean|max|maximum|min|minimum|count|find|where)\b", re.I
+)
+_OP_KIND = {
+    "sum": "sum", "total": "sum",
+    "average": "mean", "mean": "mean",
+    "max": "max", "maximum": "max",
+    "min": "min", "minimum": "min",
+    "count": "count",
+    "find": "filter", "where": "filter",
+}
+
 class ExcelTool:
     def __init__(self):
         self.df: Optional[pd.DataFrame] = None
         self.file_path: Optional[str] = None
+        self._cols: tuple = ()
+        self._cols_lower: tuple = ()
+        self._col_lookup: Dict[str, Any] = {}
+        self._mtime: Optional[int] = None
 
     def load_excel(self, file_path: str) -> None:
         """載入 Excel 文件"""
@@ -146,8 +190,20 @@ class ExcelTool:
             raise FileNotFoundError(f"File not found: {file_path}")
         
         try:
-            self.df = pd.read_excel(file_path)
+            key = (file_path, os.stat(file_path).st_mtime_ns)
+            df = _DF_CACHE.get(key)
+            if df is None:
+                # calamine 是 Rust 實現的解析器，比 openpyxl 快數倍
+                df = pd.read_excel(file_path, engine='calamine')
+                _DF_CACHE[key] = df
+                while len(_DF_CACHE) > _DF_CACHE_MAX:
+                    _DF_CACHE.popitem(last=False)
+            self.df = df
             self.file_path = file_path
+            # 預先計算小寫列名，避免每次查詢重複 lower()
+            self._cols = tuple(self.df.columns)
+            self._cols_lower = tuple(str(c).lower() for c in self._cols)
+            self._col_lookup = dict(zip(self._cols_lower, self._cols))
         except Exception as e:
             raise ValueError(f"Failed to load Excel file: {str(e)}")
 
@@ -160,20 +216,19 @@ class ExcelTool:
             col: str(dtype) for col, dtype in self.df.dtypes.items()
         }
 
-    def execute_query(self, query: str) -> ExcelQueryResult:
-        """執行自然語言查詢"""
+    def execute_query(self, query: str) -> Optional[ExcelQueryResult]:
+        """執行自然語言查詢；無法確定答案時返回 None，由調用方回退"""
         if self.df is None:
             raise ValueError("No Excel file loaded")
 
-        # 獲取基本資訊
-        info = {
-            "columns": list(self.df.columns),
-            "shape": self.df.shape,
-            "dtypes": self.get_column_info()
-        }
+        # 同時命中多種操作關鍵詞的查詢（如 "find the average ..."）
+        # 意圖不明確，不要猜
+        kinds = {_OP_KIND[k.lower()] for k in _OP_RE.findall(query)}
+        if len(kinds) != 1:
+            return None
+        op = kinds.pop()
 
-        # 根據查詢類型執行不同操作
-        if "sum" in query.lower() or "total" in query.lower():
+        if op == "sum":
             # 處理求和查詢
             col = self._extract_column_from_query(query)
             if col:
@@ -183,7 +238,7 @@ class ExcelTool:
                     explanation=f"計算了 {col} 列的總和"
                 )
 
-        elif "average" in query.lower() or "mean" in query.lower():
+        elif op == "mean":
             # 處理平均值查詢
             col = self._extract_column_from_query(query)
             if col:
@@ -193,7 +248,37 @@ class ExcelTool:
                     explanation=f"計算了 {col} 列的平均值"
                 )
 
-        elif "find" in query.lower() or "where" in query.lower():
+        elif op == "max":
+            # 處理最大值查詢
+            col = self._extract_column_from_query(query)
+            if col:
+                result = self.df[col].max()
+                return ExcelQueryResult(
+                    result=float(result),
+                    explanation=f"計算了 {col} 列的最大值"
+                )
+
+        elif op == "min":
+            # 處理最小值查詢
+            col = self._extract_column_from_query(query)
+            if col:
+                result = self.df[col].min()
+                return ExcelQueryResult(
+                    result=float(result),
+                    explanation=f"計算了 {col} 列的最小值"
+                )
+
+        elif op == "count":
+            # 處理計數查詢
+            col = self._extract_column_from_query(query)
+            if col:
+                result = self.df[col].count()
+                return ExcelQueryResult(
+                    result=int(result),
+                    explanation=f"計算了 {col} 列的非空值數量"
+                )
+
+        elif op == "filter":
             # 處理條件查詢
             condition = self._extract_condition_from_query(query)
             if condition:
@@ -203,85 +288,118 @@ class ExcelTool:
                     explanation=f"根據條件 '{condition}' 篩選了數據"
                 )
 
-        # 默認返回數據預覽
-        return ExcelQueryResult(
-            result=self.df.head().to_dict('records'),
-            explanation="返回了前 5 行數據作為預覽"
-        )
+        # 沒有找到可以確定回答的列／條件，視為未命中
+        return None
 
     def _extract_column_from_query(self, query: str) -> Optional[str]:
         """從查詢中提取列名"""
-        for col in self.df.columns:
-            if col.lower() in query.lower():
+        query_lower = query.lower()
+        # 先按詞元做 O(1) 字典查找
+        for token in _WORD_RE.findall(query_lower):
+            col = self._col_lookup.get(token)
+            if col is not None:
+                return col
+        # 多詞列名退回子串掃描
+        for col_lower, col in zip(self._cols_lower, self._cols):
+            if col_lower in query_lower:
                 return col
-        return self.df.columns[0]  # 默認使用第一列
+        # 沒有真正匹配到列名就不要猜（默認取第一列會給出錯誤答案）
+        return None
 
     def _extract_condition_from_query(self, query: str) -> Optional[str]:
         """從查詢中提取條件"""
         # 這裡使用簡單的規則，實際應用中可能需要更複雜的 NLP
-        for col in self.df.columns:
-            if col.lower() in query.lower():
-                words = query.lower().split()
-                col_idx = words.index(col.lower())
+        query_lower = query.lower()
+        words = query_lower.split()
+        for col_lower, col in zip(self._cols_lower, self._cols):
+            if col_lower in query_lower:
+                col_idx = words.index(col_lower)
                 if col_idx + 2 < len(words):
                     value = words[col_idx + 2]
                     return f"{col} == '{value}'"
         return None
 
-def get_safe_globals():
-    """Get restricted globals for safe Python execution"""
-    safe_builtins = {
-        'abs': abs, 'len': len, 'max': max, 'min': min,
-        'sum': sum, 'round': round, 'sorted': sorted,
-        'list': list, 'dict': dict, 'set': set,
-        'str': str, 'int': int, 'float': float,
-        'bool': bool, 'enumerate': enumerate,
-        'zip': zip, 'map': map, 'filter': filter,
-        'isinstance': isinstance,
-        '_getiter_': iter,
-        '_getattr_': getattr,
-        '_getitem_': lambda obj, key: obj[key],
-        '_write_': lambda x: x,
-        '_print_': lambda *args, **kwargs: None,  # 使用空的 print 函數
-        '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
-        'getattr': getattr,
-        'hasattr': hasattr,
-        'range': range,
-        'any': any, 'all': all,
-        'Exception': Exception,
-        '__import__': __import__
-    }
+def _noop_print(*args, **kwargs):
+    """空的 print 函數"""
+    return None
+
+# 不變的模板於導入時建好；可變的部分（builtins 字典、RestrictedPandas
+# 實例）每次請求重建，沙箱代碼改寫它們不會污染後續請求
+_SAFE_BUILTINS = {
+    'abs': abs, 'len': len, 'max': max, 'min': min,
+    'sum': sum, 'round': round, 'sorted': sorted,
+    'list': list, 'dict': dict, 'set': set,
+    'str': str, 'int': int, 'float': float,
+    'bool': bool, 'enumerate': enumerate,
+    'zip': zip, 'map': map, 'filter': filter,
+    'isinstance': isinstance,
+    '_getiter_': iter,
+    '_getattr_': getattr,
+    '_getitem_': lambda obj, key: obj[key],
+    '_write_': lambda x: x,
+    '_print_': _noop_print,
+    '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
+    'getattr': getattr,
+    'hasattr': hasattr,
+    'range': range,
+    'any': any, 'all': all,
+    'Exception': Exception,
+    '__import__': __import__
+}
+
+_SAFE_PD_FUNCS = (
+    'read_excel', 'ExcelFile',
+    'DataFrame', 'Series', 'Index',
+    'concat', 'merge', 'to_datetime', 'to_json', 'json_normalize',
+    'isnull', 'notnull', 'isna', 'notna',
+    'groupby', 'agg', 'sum', 'mean', 'count', 'value_counts',
+    'sort_values', 'head', 'tail', 'loc', 'iloc',
+    'fillna', 'dropna', 'replace',
+    'reset_index', 'set_index',
+    'astype', 'convert_dtypes',
+    'date_range', 'to_datetime',
+    'str',
+)
 
-    safe_pd_funcs = [
-        'read_excel', 'ExcelFile',
-        'DataFrame', 'Series', 'Index',
-        'concat', 'merge', 'to_datetime', 'to_json', 'json_normalize',
-        'isnull', 'notnull', 'isna', 'notna',
-        'groupby', 'agg', 'sum', 'mean', 'count', 'value_counts',
-        'sort_values', 'head', 'tail', 'loc', 'iloc',
-        'fillna', 'dropna', 'replace',
-        'reset_index', 'set_index',
-        'astype', 'convert_dtypes',
-        'date_range', 'to_datetime',
-        'str',
-    ]
-    
-    restricted_pd = type('RestrictedPandas', (), {
-        attr: getattr(pd, attr) 
-        for attr in safe_pd_funcs 
-        if hasattr(pd, attr)
-    })()
+# getattr 反射只做一次，之後每次用它重建新的 RestrictedPandas
+_SAFE_PD_ATTRS = {
+    attr: getattr(pd, attr)
+    for attr in _SAFE_PD_FUNCS
+    if hasattr(pd, attr)
+}
 
+def get_safe_globals():
+    """Get restricted globals for safe Python execution"""
+    # RestrictedPandas 實例與 builtins 字典都是新的，讓每次執行互相隔離：
+    # 生成的代碼就算改寫 pd 的屬性也只影響本次執行
+    restricted_pd = type('RestrictedPandas', (), dict(_SAFE_PD_ATTRS))()
     return {
-        '__builtins__': safe_builtins,
+        '__builtins__': dict(_SAFE_BUILTINS),
         'pd': restricted_pd,
         'json': json,
         'isinstance': isinstance,
         'getattr': getattr,
         'hasattr': hasattr,
-        'print': lambda *args, **kwargs: None,  # 使用空的 print 函數
+        'print': _noop_print,
     }
 
+@functools.lru_cache(maxsize=256)
+def _compile_restricted_cached(source: str):
+    """按源碼快取 RestrictedPython 編譯結果，重複查詢跳過 AST 轉換"""
+    return compile_restricted(source, '<inline>', 'exec')
+
+# 固定的生成指示放在提示詞開頭，讓供應商的前綴快取（如 OpenAI
+# prompt caching）可以命中；每次查詢變動的內容全部排在後面
+_CODE_PROMPT_INSTRUCTIONS = """Please generate Python code to analyze the Excel file.
+
+Please generate code that meets the following requirements:
+1. Use pandas to read and process the data
+2. Use English variable names to avoid Chinese characters
+3. Ensure the result variable contains the final result
+4. Use try-except to handle exceptions
+5. If the result is a DataFrame or Series, use to_json(orient='records', force_ascii=False) to convert it to a JSON string
+6. store result in a variable named 'result'"""
+
 def generate_code_prompt(
     file_path: str,
     sheet_names: List[str],
@@ -290,8 +408,8 @@ def generate_code_prompt(
     dtypes: Dict[str, Any],
     query: str
 ) -> str:
-    """生成代碼提示"""
-    return f"""Please generate Python code to analyze the Excel file.
+    """生成代碼提示（固定指示在前，查詢相關信息在後）"""
+    return f"""{_CODE_PROMPT_INSTRUCTIONS}
 
 File information:
 - File path: {file_path}
@@ -300,15 +418,7 @@ File information:
 - Column names: {columns}
 - Data types: {dtypes}
 
-Query content: {query}
-
-Please generate code that meets the following requirements:
-1. Use pandas to read and process the data
-2. Use English variable names to avoid Chinese characters
-3. Ensure the result variable contains the final result
-4. Use try-except to handle exceptions
-5. If the result is a DataFrame or Series, use to_json(orient='records', force_ascii=False) to convert it to a JSON string
-6. store result in a variable named 'result'"""
+Query content: {query}"""
 
 excel_agent = Agent(
     os.getenv('AI_MODEL', 'openai:gpt-4o-mini-2024-07-18'),
@@ -324,13 +434,144 @@ excel_agent = Agent(
 3. 將工具返回的結果直接返回給用戶，不要添加任何額外的解釋"""
 )
 
-excel_tool = ExcelTool()
+# 每個文件一個常駐 ExcelTool，文件未變動時直接重用已載入的 DataFrame；
+# 上限與 _DF_CACHE 一致，否則被淘汰的 DataFrame 仍被工具實例引用著
+_TOOLS: "OrderedDict[str, ExcelTool]" = OrderedDict()
+_TOOLS_MAX = _DF_CACHE_MAX
+
+def _get_tool(file_path: str) -> ExcelTool:
+    """獲取（或按需重建）對應文件的 ExcelTool 實例"""
+    mtime = os.stat(file_path).st_mtime_ns
+    tool = _TOOLS.get(file_path)
+    if tool is None or tool._mtime != mtime:
+        tool = ExcelTool()
+        tool.load_excel(file_path)
+        tool._mtime = mtime
+        _TOOLS[file_path] = tool
+        while len(_TOOLS) > _TOOLS_MAX:
+            _TOOLS.popitem(last=False)
+    return tool
+
+# <dimension ref="A1:G123"/> 中結尾的列字母與行號
+_DIM_REF_RE = re.compile(r"([A-Z]+)(\d+)$")
+
+def _col_letters_to_num(letters: str) -> int:
+    """把 'A'/'AB' 這類列字母轉成列數"""
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def _xlsx_dimension(file_path: str) -> Optional[tuple]:
+    """從 xlsx 的 dimension 標籤讀取第一個工作表的 (總行數, 總列數)
+
+    只解壓讀取工作表 XML 開頭的幾個位元組，不掃描任何數據行；
+    沒有 dimension 標籤或文件異常時返回 None，由調用方回退。
+    """
+    try:
+        with zipfile.ZipFile(file_path) as z:
+            with z.open('xl/worksheets/sheet1.xml') as f:
+                for _, el in ET.iterparse(f, events=('start',)):
+                    if el.tag.endswith('}dimension'):
+                        m = _DIM_REF_RE.search(el.attrib.get('ref', ''))
+                        if m:
+                            return int(m.group(2)), _col_letters_to_num(m.group(1))
+                        return None
+                    if el.tag.endswith('}sheetData'):
+                        break
+    except (KeyError, zipfile.BadZipFile, ET.ParseError, OSError):
+        pass
+    return None
+
+def _xlsx_total_rows(file_path: str) -> Optional[int]:
+    dim = _xlsx_dimension(file_path)
+    return dim[0] if dim else None
+
+@functools.lru_cache(maxsize=64)
+def _excel_meta(file_path: str, mtime_ns: int, size: int):
+    """讀取 Excel 文件的元數據（工作表、列名、數據類型、總行數）
+
+    以 (file_path, mtime_ns, size) 作為快取鍵，文件更新時自然失效。
+    """
+    with pd.ExcelFile(file_path, engine='calamine') as xls:
+        sheet_names = xls.sheet_names
+        df_preview = xls.parse(sheet_name=0, nrows=5)
+
+        if file_path.endswith(('.xlsx', '.xlsm')):
+            total_rows = _xlsx_total_rows(file_path)
+            if total_rows is None:
+                # 沒有 dimension 標籤時才退回 openpyxl
+                import openpyxl
+                wb = openpyxl.load_workbook(file_path, read_only=True)
+                total_rows = wb[sheet_names[0]].max_row
+                wb.close()
+        else:
+            # 只讀第一列來計算行數，避免載入整個工作表
+            total_rows = len(xls.parse(sheet_name=0, usecols=[0]))
+
+    return sheet_names, list(df_preview.columns), df_preview.dtypes.to_dict(), total_rows
+
+def _orjson_default(obj):
+    """orjson 拒絕 datetime 的子類（pd.Timestamp 等），這裡轉成 ISO 字符串
+
+    NaT 對應 null，與原本 to_json(date_format='iso') 的行為一致。
+    """
+    if obj is pd.NaT:
+        return None
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def _normalize_key(key):
+    """把 orjson 無法接受的字典鍵（如 Timestamp 列名、groupby 鍵）轉掉"""
+    if key is None or isinstance(key, (str, int, float, bool)):
+        return key
+    if key is pd.NaT:
+        return None
+    if isinstance(key, (datetime.date, datetime.time)):
+        return key.isoformat()
+    return str(key)
+
+def _normalize_keys(obj):
+    """遞迴正規化容器裡的字典鍵
+
+    orjson 的 default= 只套用在值上，鍵不經過它；即使開了
+    OPT_NON_STR_KEYS，datetime 子類（pd.Timestamp）當鍵仍會報錯，
+    所以序列化前先走一遍。
+    """
+    if isinstance(obj, dict):
+        return {_normalize_key(k): _normalize_keys(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_normalize_keys(v) for v in obj]
+    return obj
+
+def _excel_shape(file_path: str) -> tuple:
+    """獲取 Excel 文件的 (數據行數, 列數)，不載入整個工作表"""
+    if file_path.endswith(('.xlsx', '.xlsm')):
+        # dimension 標籤（和 openpyxl 的 max_column）反映的是「格式化過的
+        # 使用範圍」，樣式會把寬度撐大；列數以只讀表頭的解析結果為準
+        columns = len(
+            pd.read_excel(file_path, nrows=0, engine='calamine').columns
+        )
+        dim = _xlsx_dimension(file_path)
+        if dim is not None:
+            return max(dim[0] - 1, 0), columns
+        import openpyxl
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        ws = wb[wb.sheetnames[0]]
+        rows = max(ws.max_row - 1, 0)
+        wb.close()
+    else:
+        # .xls 沒有便宜的元數據讀取方式，退回 pandas
+        df = pd.read_excel(file_path, engine='calamine')
+        rows, columns = df.shape
+    return rows, columns
 
 @excel_agent.tool
 async def analyze_excel(ctx: RunContext[AgentDependencies], query: str) -> AnalysisResult:
     """分析 Excel 文件並回答查詢"""
-    logger.info(f"Starting Excel analysis with query: {query}")
-    logger.info(f"Using model: {ctx.model}")
+    logger.info("Starting Excel analysis with query: %s", query)
+    logger.debug("Using model: %s", ctx.model)
     
     if not ctx.deps or not ctx.deps.file_path:
         return AnalysisResult(content="Excel文件路徑未提供。")
@@ -344,65 +585,96 @@ async def analyze_excel(ctx: RunContext[AgentDependencies], query: str) -> Analy
         return AnalysisResult(content=f"不支持的文件格式。請上傳 Excel 文件 (.xlsx, .xls, .xlsm)")
 
     try:
-        # 先嘗試使用簡單的查詢工具
-        with pd.ExcelFile(file_path) as xls:
-            sheet_names = xls.sheet_names
-            df_preview = pd.read_excel(xls, sheet_name=0, nrows=5)
-            
-            if file_path.endswith('.xlsx'):
-                import openpyxl
-                wb = openpyxl.load_workbook(file_path, read_only=True)
-                sheet = wb[sheet_names[0]]
-                total_rows = sheet.max_row
-                wb.close()
-            else:
-                df_info = pd.read_excel(xls, sheet_name=0)
-                total_rows = len(df_info)
-
-        code_prompt = generate_code_prompt(
-            file_path=file_path,
-            sheet_names=sheet_names,
-            total_rows=total_rows,
-            columns=list(df_preview.columns),
-            dtypes=df_preview.dtypes.to_dict(),
-            query=query
+        # 簡單聚合查詢（sum/mean/find 等）直接用 pandas 回答，省去一次 LLM 往返
+        if _OP_RE.search(query):
+            try:
+                tool = await asyncio.to_thread(_get_tool, file_path)
+                simple_result = await asyncio.to_thread(tool.execute_query, query)
+                if simple_result is not None:
+                    return AnalysisResult(
+                        content=f"分析結果：\n{simple_result.model_dump_json()}"
+                    )
+                logger.info("Fast-path miss, falling back to code generation")
+            except Exception:
+                logger.exception("Fast-path query failed, falling back to code generation")
+
+        # 使用快取的元數據，避免每次查詢都重新解析 Excel
+        st = os.stat(file_path)
+        sheet_names, columns, dtypes, total_rows = await asyncio.to_thread(
+            _excel_meta, file_path, st.st_mtime_ns, st.st_size
         )
 
-        logger.info(f"Sending code generation request to model: {excel_agent.model}")
-        code_response = await excel_agent.run(code_prompt)
-        
-        python_code = ""
-        try:
-            python_code = code_response.data
-            logger.debug("\n\n")
-            logger.debug("Raw code response.data: \n\n%s", python_code)
-            logger.debug("\n\n")
-        except Exception as e:
-            logger.error("Error extracting Python code: %s", str(e))
-            python_code = "Error: Unable to retrieve code"
+        # 同一文件（簽名）+ 同一查詢直接重用上次清理好的代碼
+        cache_key = (file_path, f"{st.st_mtime_ns}:{st.st_size}", query)
+        python_code = _CODE_CACHE.get(cache_key)
+
+        if python_code is None:
+            code_prompt = generate_code_prompt(
+                file_path=file_path,
+                sheet_names=sheet_names,
+                total_rows=total_rows,
+                columns=columns,
+                dtypes=dtypes,
+                query=query
+            )
 
-        logger.info("Code content before cleaning: %s\n\n", python_code)
+            logger.info("Sending code generation request to model: %s", excel_agent.model)
+            code_response = await excel_agent.run(code_prompt)
+
+            try:
+                raw_code = code_response.data
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Raw code response.data: \n\n%s", raw_code)
+            except Exception as e:
+                logger.error("Error extracting Python code: %s", str(e))
+                raw_code = "Error: Unable to retrieve code"
+
+            if (isinstance(raw_code, str) and raw_code
+                    and '```' not in raw_code and 'RunResult(' not in raw_code):
+                # 模型直接給出乾淨代碼時跳過整個清理管線
+                python_code = raw_code.strip()
+            else:
+                python_code = CleanCodeResult(code=raw_code).code
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Code content after cleaning:\n\n %s", python_code)
 
-        python_code = CleanCodeResult(code=code_response.data).code
-        logger.info("Code content after cleaning:\n\n %s", python_code)
+            _CODE_CACHE[cache_key] = python_code
+            while len(_CODE_CACHE) > _CODE_CACHE_MAX:
+                _CODE_CACHE.popitem(last=False)
 
         globals_dict = get_safe_globals()
         globals_dict['FILE_PATH'] = file_path
 
-
-        logger.info("\n\nExecuting compiled code in sandbox...\n")
+        logger.debug("Executing compiled code in sandbox...")
         try:
-            byte_code = compile_restricted(python_code, '<inline>', 'exec')
-            exec(byte_code, globals_dict)
+            byte_code = await asyncio.to_thread(_compile_restricted_cached, python_code)
+            # 在工作執行緒中執行，避免 pandas 重活阻塞事件迴圈
+            await asyncio.to_thread(exec, byte_code, globals_dict)
             
             result = globals_dict.get('result')
             if result is None:
                 return AnalysisResult(content="代碼執行完成，但未生成結果。")
 
-            if isinstance(result, (pd.DataFrame, pd.Series)):
-                result = result.to_json(orient='records', date_format='iso', force_ascii=False)
+            if isinstance(result, pd.DataFrame):
+                # 非字符串列名（如整數列）也要能當字典鍵序列化
+                result = orjson.dumps(
+                    _normalize_keys(result.to_dict(orient='records')),
+                    default=_orjson_default,
+                    option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                ).decode()
+            elif isinstance(result, pd.Series):
+                result = orjson.dumps(
+                    result.tolist(),
+                    default=_orjson_default,
+                    option=orjson.OPT_SERIALIZE_NUMPY
+                ).decode()
             elif not isinstance(result, str):
-                result = json.dumps(result, ensure_ascii=False)
+                # OPT_NON_STR_KEYS：groupby 之類的結果常帶非字符串鍵
+                result = orjson.dumps(
+                    _normalize_keys(result),
+                    default=_orjson_default,
+                    option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                ).decode()
 
             return AnalysisResult(content=f"""分析結果：
 
@@ -440,15 +712,13 @@ async def analyze_excel(ctx: RunContext[AgentDependencies], query: str) -> Analy
         logger.exception("Error in analyze_excel")
         return AnalysisResult(content=f"處理Excel文件時發生錯誤：{str(e)}")
 
-    except Exception as e:
-        logger.exception("Error in analyze_excel")
-        return AnalysisResult(content=f"處理Excel文件時發生錯誤：{str(e)}")
-
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
+# 具體的來源列表讓 Starlette 走預檢快速路徑；"*" 配上 credentials
+# 會強制逐請求檢查（且本身就不符合規範）
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=os.getenv("CORS_ORIGINS", "http://localhost:3000").split(","),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -499,7 +769,7 @@ async def query_excel(request: ExcelQuery) -> Dict[str, Any]:
             
             if not os.path.exists(request.file_path):
                 logger.error(f"File not found: {request.file_path}")
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=404,
                     content={"error": f"File not found: {request.file_path}"}
                 )
@@ -516,25 +786,26 @@ async def query_excel(request: ExcelQuery) -> Dict[str, Any]:
                     deps=deps
                 )
                 
-                logger.info(f"Successfully analyzed Excel file: {response}")
-                return JSONResponse(content=response.data)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Successfully analyzed Excel file: %s", response)
+                return ORJSONResponse(content=response.data)
                 
             except Exception as e:
                 logger.error(f"Failed to analyze Excel file: {str(e)}")
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=400,
                     content={"error": f"無法分析 Excel 文件: {str(e)}"}
                 )
         else:
             logger.error("No file path provided")
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=400,
                 content={"error": "請提供 Excel 文件路徑"}
             )
             
     except Exception as e:
         logger.error(f"Error querying Excel: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": f"查詢失敗: {str(e)}"}
         )
@@ -543,40 +814,36 @@ async def query_excel(request: ExcelQuery) -> Dict[str, Any]:
 async def chat(message: Dict[str, Any]) -> StreamingResponse:
     try:
         logger.info("Received request: %s", message)
-        
+
+        content = message.get("content", "")
+        file_path = message.get("file_path", "")
+
+        if not file_path:
+            return PlainTextResponse(
+                "看起來您還沒有上傳任何 Excel 檔案，因此我無法進行分析。請上傳檔案後重試。"
+            )
+
+        if not os.path.isabs(file_path):
+            file_path = os.path.abspath(file_path)
+        file_path = os.path.normpath(file_path)
+
+        if not os.path.exists(file_path):
+            return PlainTextResponse(f"找不到檔案：{file_path}")
+
+        deps = AgentDependencies(file_path=file_path)
+
         async def generate_response():
-            content = message.get("content", "")
-            file_path = message.get("file_path", "")
-            
-            if not file_path:
-                yield "看起來您還沒有上傳任何 Excel 檔案，因此我無法進行分析。請上傳檔案後重試。"
-                return
-            
-            if not os.path.isabs(file_path):
-                file_path = os.path.abspath(file_path)
-            file_path = os.path.normpath(file_path)
-                
-            if not os.path.exists(file_path):
-                yield f"找不到檔案：{file_path}"
-                return
-            
-            deps = AgentDependencies(file_path=file_path)
+            """逐 token 轉發 LLM 輸出，TTFB 不再等整個分析完成"""
             try:
-                result = await excel_agent.run(content, deps=deps)
-                
-                if hasattr(result, 'data'):
-                    if isinstance(result.data, AnalysisResult):
-                        yield result.data.content
-                    else:
-                        yield str(result.data)
-                else:
-                    yield str(result)
+                async with excel_agent.run_stream(content, deps=deps) as stream:
+                    async for chunk in stream.stream_text(delta=True):
+                        yield chunk
             except Exception as e:
                 yield f"處理過程中發生錯誤：{str(e)}"
 
         return StreamingResponse(generate_response(), media_type="text/plain")
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content=ErrorResponse(error=str(e)).dict()
         )
@@ -600,15 +867,15 @@ async def upload_file(file: UploadFile = File(...)):
             logger.error(error_msg)
             raise HTTPException(status_code=400, detail=error_msg)
         
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-            logger.info(f"File saved: {file_path}")
-        
+        # 分塊寫入磁盤，避免將整個文件緩衝在內存中
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(1 << 20):
+                await buffer.write(chunk)
+        logger.info(f"File saved: {file_path}")
+
         try:
             logger.info("Reading Excel file...")
-            df = pd.read_excel(file_path)
-            rows, columns = df.shape
+            rows, columns = await asyncio.to_thread(_excel_shape, file_path)
             logger.info(f"Excel file read successfully: {rows} rows, {columns} columns")
         except Exception as e:
             error_msg = f"無法讀取 Excel 文件: {str(e)}"
@@ -627,14 +894,14 @@ async def upload_file(file: UploadFile = File(...)):
         
     except HTTPException as he:
         logger.error(f"HTTP Exception: {he.detail}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=he.status_code,
             content={"error": he.detail}
         )
     except Exception as e:
         error_msg = f"上傳失敗: {str(e)}"
         logger.error(f"Unexpected error: {error_msg}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": error_msg}
         )
@@ -0,0 +1,36 @@
+import pandas as pd
+import orjson
+
+from main import _normalize_keys, _orjson_default
+
+
+def _dump(obj):
+    return orjson.dumps(
+        _normalize_keys(obj),
+        default=_orjson_default,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+    )
+
+
+def test_datetime_keyed_frame_serializes():
+    # Timestamp 當列名：鍵必須在序列化前轉成 ISO 字符串
+    ts = pd.Timestamp("2024-01-02 03:04:05")
+    df = pd.DataFrame({ts: [1, 2], "name": ["a", "b"]})
+    payload = _dump(df.to_dict(orient="records"))
+    assert b"2024-01-02T03:04:05" in payload
+
+
+def test_timestamp_values_and_nat_serialize():
+    df = pd.DataFrame({
+        "when": [pd.Timestamp("2024-06-30"), pd.NaT],
+        "value": [1.5, 2.5],
+    })
+    payload = _dump(df.to_dict(orient="records"))
+    assert b"2024-06-30" in payload
+    assert b"null" in payload
+
+
+def test_timestamp_groupby_keys_serialize():
+    grouped = {pd.Timestamp("2024-01-01"): 10, pd.Timestamp("2024-01-02"): 20}
+    payload = _dump(grouped)
+    assert b"2024-01-01" in payload and b"2024-01-02" in payload